@@ -1,8 +1,10 @@
 import streamlit as st
 import pandas as pd
 import requests
-import time
-import json
+import orjson
+
+import sync_core
+from sync_core import REQUIRED_FIELDS
 
 # --- PAGE SETUP ---
 st.set_page_config(page_title="Data Sync Pro", page_icon="⏱️", layout="centered")
@@ -11,6 +13,173 @@ st.title("⏱️ Data Sync Pro")
 st.markdown("Syncing CSV data with forced String types and CURL debugging.")
 st.divider()
 
+# --- HTTP SESSION ---
+def get_session(pool_size):
+    """Return a keep-alive session that survives Streamlit reruns.
+
+    Reusing one session means the TCP socket, TLS session and DNS lookup are
+    paid once per run instead of once per batch.
+    """
+    session = st.session_state.get("http_session")
+    if session is None:
+        session = requests.Session()
+        st.session_state["http_session"] = session
+    # Only re-mount when the pool size changes, otherwise pooled connections are kept.
+    # The pool must hold one connection per worker, or urllib3 discards the extras
+    # ("Connection pool is full") and every overflow request reconnects.
+    if st.session_state.get("http_pool_size") != pool_size:
+        old_adapter = session.adapters.get("https://")
+        if old_adapter is not None:
+            old_adapter.close()
+        adapter = sync_core.make_adapter(pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        st.session_state["http_pool_size"] = pool_size
+    return session
+
+def get_client(pool_size, http2):
+    """Return the HTTP/2 client when enabled, otherwise the requests session."""
+    if not http2:
+        return get_session(pool_size)
+    client = st.session_state.get("http2_client")
+    if client is None or st.session_state.get("http2_pool_size") != pool_size:
+        if client is not None:
+            client.close()
+        client = sync_core.make_http2_client(pool_size)
+        st.session_state["http2_client"] = client
+        st.session_state["http2_pool_size"] = pool_size
+    return client
+
+# --- CSV LOADING ---
+# The cache is shared by every session on the server and each entry holds a
+# whole parsed upload, so it is kept small and entries expire after an hour
+@st.cache_data(show_spinner=False, max_entries=8, ttl=3600)
+def parse_csv(file_id, header_map, dedupe, _file_bytes):
+    """Parse and clean the uploaded CSV into an Arrow IPC buffer.
+
+    Returns the buffer and the number of skipped and duplicate rows. Duplicate
+    ids are only dropped with `dedupe`. Cached on the upload's file_id, the
+    header map and `dedupe`, so widget changes never re-run the CSV
+    tokenizer. The bytes themselves are left out of the key (leading
+    underscore); hashing a large upload on every rerun costs more than a lookup.
+    The cache holds plain bytes, which are cheap to hand back on every rerun.
+    """
+    df, skipped = sync_core.clean_frame(sync_core.read_csv(_file_bytes, header_map))
+    duplicates = 0
+    if dedupe:
+        df, duplicates = sync_core.drop_duplicate_ids(df)
+    return sync_core.to_arrow_ipc(df), skipped, duplicates
+
+def load_table(uploaded_file, header_map, dedupe):
+    """Return the cleaned data as an Arrow table and the skipped and duplicate row counts, from the cache."""
+    ipc_bytes, skipped, duplicates = parse_csv(uploaded_file.file_id, header_map, dedupe, uploaded_file.getvalue())
+    return sync_core.from_arrow_ipc(ipc_bytes), skipped, duplicates
+
+# --- BATCH LOGGING ---
+# Runs on the sync thread, so nothing here may call Streamlit. Every batch adds
+# a row to job.log_rows and failures also add their details to job.failures;
+# the job view renders both.
+LOG_TAIL = 200
+FAILURE_TAIL = 20
+# Responses are cut short in the table; failures keep the full text in their expander
+LOG_MSG_MAX_LEN = 300
+
+def _log_row(batch_num, status, batch, result, msg=""):
+    return {
+        "batch": batch_num,
+        "status": status,
+        "items": len(batch),
+        "ok": status == 200,
+        "result": result,
+        "msg": msg[:LOG_MSG_MAX_LEN]
+    }
+
+def _failure(title, response, hint=None, sample=None):
+    return {"title": title, "response": response, "hint": hint, "sample": sample}
+
+def _log_success(resp, batch_num, batch, show_details, job):
+    job.log_rows.append(_log_row(batch_num, resp.status_code, batch, "✅ Success", sync_core.response_text(resp) if show_details else ""))
+
+def _log_auth_failure(resp, batch_num, batch, show_details, job):
+    text = sync_core.response_text(resp)
+    job.log_rows.append(_log_row(batch_num, resp.status_code, batch, "🔒 Rejected", text))
+    job.failures.append(_failure(
+        f"🔒 Batch {batch_num}: Rejected (Status {resp.status_code})",
+        text,
+        hint="Check the Retailer ID and Token."
+    ))
+
+def _log_failure(resp, batch_num, batch, show_details, job):
+    text = sync_core.response_text(resp)
+    job.log_rows.append(_log_row(batch_num, resp.status_code, batch, "❌ Failed", text))
+    # Keep the first item to verify brand_id is a string
+    job.failures.append(_failure(f"❌ Batch {batch_num}: Failed (Status {resp.status_code})", text, sample=batch[0]))
+
+# Status code -> log handler; anything not listed is a generic failure
+STATUS_HANDLERS = {
+    200: _log_success,
+    401: _log_auth_failure,
+    403: _log_auth_failure,
+}
+
+def log_batch_result(job, batch_num, batch, future, show_details):
+    """Record a finished batch in the job's transaction log."""
+    try:
+        resp = future.result()
+    except Exception as e:
+        job.log_rows.append(_log_row(batch_num, None, batch, "⚠️ Network Error", str(e)))
+        job.failures.append(_failure(f"⚠️ Batch {batch_num}: Network Error", str(e)))
+        return
+    
+    # Handlers only decode the body when they display it, so successful
+    # batches with Show Raw Server Responses off never decode their body
+    handler = STATUS_HANDLERS.get(resp.status_code, _log_failure)
+    handler(resp, batch_num, batch, show_details, job)
+
+# --- JOB VIEW ---
+def _show_response(text):
+    """Render a response body; Streamlit parses JSON strings itself, so there's no decode here."""
+    if text.lstrip()[:1] in ("{", "["):
+        st.json(text)
+    else:
+        st.code(text)
+
+def render_job(job, live):
+    """Draw the progress, log table and failure details of a sync job."""
+    result = job.result
+    done = result.done_records
+    # An empty table still starts a job; don't divide by its zero rows
+    st.progress(min(done / max(job.total_records, 1), 1.0) if live else 1.0)
+    st.caption(f"Processing... {done}/{job.total_records}" if live else f"Processed {done} records.")
+    
+    st.subheader("Transaction Logs")
+    log_rows = job.log_rows[-LOG_TAIL:] if live else job.log_rows
+    if log_rows:
+        st.dataframe(pd.DataFrame(log_rows), width="stretch")
+    
+    failures = job.failures[-FAILURE_TAIL:]
+    if len(job.failures) > len(failures):
+        st.caption(f"Showing details for the last {len(failures)} of {len(job.failures)} failed batches.")
+    for failure in failures:
+        with st.expander(failure["title"], expanded=True):
+            if failure["hint"]:
+                st.write(f"**{failure['hint']}**")
+            if failure["sample"] is not None:
+                st.write("**Request Payload Sample (First Item):**")
+                st.json(failure["sample"])
+            st.write("**Server Response:**")
+            _show_response(failure["response"])
+
+@st.fragment(run_every=0.5)
+def job_monitor(job):
+    """Redraw only the job view, twice a second, while the sync thread runs."""
+    if job.finished.is_set():
+        # Hand over to a full rerun, which draws the final view
+        st.rerun()
+    render_job(job, live=True)
+    if st.button("⏹️ Cancel Sync", disabled=job.cancel.is_set()):
+        job.cancel.set()
+
 # --- SIDEBAR CONFIGURATION ---
 with st.sidebar:
     st.header("⚙️ Connection Settings")
@@ -27,8 +196,22 @@ with st.sidebar:
         
     st.divider()
     st.header("⚡ Performance Control")
-    req_per_sec = st.slider("Max Requests per Second", 1, 10, 5, help="Controls the speed to avoid hitting API limits.")
+    limit_rate = st.checkbox("Limit Request Rate", value=True, help="When off, batches are sent as fast as the parallel requests allow and the server's 429 / Retry-After responses do the throttling.")
+    req_per_sec = st.slider("Max Requests per Second", 1, 10, 5, disabled=not limit_rate, help="Controls the speed to avoid hitting API limits.")
     batch_size = st.slider("Batch Size", 10, 100, 50)
+    concurrency = st.slider("Parallel Requests", 1, 32, 8, help="Batches in flight at once. Raise it until the server starts answering 429.")
+    http2 = st.checkbox(
+        "Use HTTP/2",
+        value=False,
+        disabled=not sync_core.HTTP2_AVAILABLE,
+        help="Multiplexes all in-flight batches over one connection. Needs `httpx[http2]` installed and an endpoint that speaks HTTP/2."
+    )
+    low_memory = st.checkbox(
+        "Low Memory Mode",
+        value=False,
+        help="Streams rows from the file during the sync instead of loading it up front. Files over 200 MB are never cached; with Polars installed they are loaded and cleaned when the sync starts, otherwise they are always streamed."
+    )
+    compress = st.checkbox("Gzip Request Bodies", value=False, help="Sends batches with Content-Encoding: gzip. If the endpoint answers 415, the sync falls back to plain bodies.")
     
     st.divider()
     st.header("🗺️ Source Map")
@@ -36,109 +219,148 @@ with st.sidebar:
     default_headers = "dealer_code, city, state, id, brand_id, category, image_link, link, description, title, price, availability"
     headers_input = st.text_area("CSV Header Map", value=default_headers, height=150)
     
+    dedupe_ids = st.checkbox(
+        "Drop Duplicate IDs",
+        value=False,
+        help="Sends only the last row for each product id. Leave off when the same id legitimately repeats, e.g. once per dealer. Not applied in Low Memory Mode."
+    )
+    
     show_details = st.checkbox("Show Raw Server Responses", value=True)
 
 # --- MAIN INTERFACE ---
 uploaded_file = st.file_uploader("📂 Upload Source CSV", type=["csv"])
 
+# The sync runs on a background thread, so the page stays responsive and
+# reruns don't interrupt it; the job lives in session_state between reruns and
+# is drawn below whatever happens to the upload, so it can always be cancelled
+sync_job = st.session_state.get("sync_job")
+running = sync_job is not None and not sync_job.finished.is_set()
+if sync_job is not None and not running and uploaded_file and uploaded_file.file_id != sync_job.file_id:
+    # A finished job's results belong to the previous file
+    del st.session_state["sync_job"]
+    sync_job = None
+
 if uploaded_file:
-    user_headers = [h.strip() for h in headers_input.split(',') if h.strip()]
+    header_map = sync_core.parse_headers(headers_input)
     
     try:
-        # CRITICAL: dtype=str ensures brand_id and dealer_code are strings, not numbers
-        df = pd.read_csv(
-            uploaded_file, 
-            names=user_headers, 
-            header=0, 
-            encoding='utf-8-sig',
-            dtype=str
-        )
+        file_bytes = uploaded_file.getvalue()
+        
+        # Check the header map against the file's header row before any full parse
+        file_header = sync_core.read_header(file_bytes)
+        if header_map and len(header_map) != len(file_header):
+            raise ValueError(f"CSV Header Map has {len(header_map)} columns but the file has {len(file_header)}: {', '.join(file_header)}")
         
-        # Replace NaN values with empty strings to keep JSON clean
-        df = df.fillna("")
+        streaming = low_memory or uploaded_file.size > sync_core.STREAM_THRESHOLD_BYTES
+        # Too big to cache, but Polars can still clean it column-wise
+        use_polars = streaming and not low_memory and sync_core.pl is not None
+        
+        if streaming:
+            preview = sync_core.read_csv(file_bytes, header_map, nrows=3)
+            # Rough row count for the progress bar, taken without parsing the file
+            total_records = max(file_bytes.count(b"\n") - 1, 1)
+            if use_polars:
+                st.info("Large file: it is loaded and cleaned with Polars when the sync starts instead of being cached up front.")
+            else:
+                st.info("Low memory mode: rows are streamed during the sync instead of being loaded up front.")
+            st.write(f"**Preview (~{total_records} rows):**")
+        else:
+            table, skipped, duplicates = load_table(uploaded_file, header_map, dedupe_ids)
+            preview = table.slice(0, 3).to_pandas()
+            total_records = table.num_rows
         
-        st.write(f"**Preview ({len(df)} rows):**")
-        st.dataframe(df.head(3))
+        required = [c for c in REQUIRED_FIELDS if c in preview.columns]
+        if not streaming:
+            if skipped:
+                st.warning(f"Skipped {skipped} rows missing {', '.join(required)}.")
+            if duplicates:
+                st.info(f"Dropped {duplicates} duplicate IDs, keeping the last row for each.")
+            st.write(f"**Preview ({total_records} rows):**")
+        st.dataframe(preview)
         
-        if st.button("🚀 Start Synchronization", type="primary"):
+        if st.button("🚀 Start Synchronization", type="primary", disabled=running):
             if not token:
                 st.error("❌ API Token is missing!")
             else:
                 # --- CURL GENERATOR FOR DEBUGGING ---
                 # We generate the CURL for the first batch to verify the payload format
-                first_batch = df.head(batch_size).to_dict(orient='records')
+                if streaming:
+                    preview_batches = sync_core.iter_csv_batches(file_bytes, header_map, batch_size, {"skipped": 0})
+                else:
+                    preview_batches = sync_core.iter_batches(table, batch_size)
+                _, first_batch = next(preview_batches, (1, []))
                 sample_payload = {"products": first_batch}
                 
                 curl_command = f"""curl --location '{url}' \\
 --header 'Content-Type: application/json' \\
 --header 'x-retailer-id: {retailer_id}' \\
 --header 'x-token: {token}' \\
---data '{json.dumps(sample_payload)}'"""
-
-                st.subheader("🛠️ Debug: First Batch CURL")
-                st.info("Copy this to your terminal to test the API manually:")
-                st.code(curl_command, language="bash")
-                
-                st.divider()
+--data '{orjson.dumps(sample_payload).decode()}'"""
                 
                 # --- PROCESSING LOOP ---
-                progress_bar = st.progress(0)
-                status_box = st.empty()
-                st.subheader("Transaction Logs")
+                # Headers are constant for the whole run, set them once on the session
+                session = get_client(concurrency, http2)
+                session.headers.update({
+                    'Content-Type': 'application/json',
+                    'x-retailer-id': retailer_id,
+                    'x-token': token
+                })
                 
-                success_count = 0
-                error_count = 0
-                records = df.to_dict(orient='records')
-                total_records = len(records)
-                sleep_time = 1.0 / req_per_sec
+                stats = {"skipped": 0, "duplicates": 0}
+                if use_polars:
+                    batches = sync_core.iter_polars_batches(file_bytes, header_map, batch_size, stats, dedupe=dedupe_ids)
+                elif streaming:
+                    batches = sync_core.iter_csv_batches(file_bytes, header_map, batch_size, stats)
+                else:
+                    batches = sync_core.iter_batches(table, batch_size)
                 
-                for i in range(0, total_records, batch_size):
-                    batch = records[i:i+batch_size]
-                    
-                    api_headers = {
-                        'Content-Type': 'application/json',
-                        'x-retailer-id': retailer_id,
-                        'x-token': token
-                    }
-                    payload = {"products": batch}
-
-                    try:
-                        resp = requests.post(url, json=payload, headers=api_headers)
-                        
-                        try:
-                            server_response = resp.json()
-                        except:
-                            server_response = resp.text
-                        
-                        batch_num = (i // batch_size) + 1
-                        
-                        if resp.status_code == 200:
-                            success_count += len(batch)
-                            with st.expander(f"✅ Batch {batch_num}: Success ({len(batch)} items)", expanded=False):
-                                st.write(f"**Status:** {resp.status_code}")
-                                if show_details:
-                                    st.json(server_response)
-                        else:
-                            error_count += len(batch)
-                            with st.expander(f"❌ Batch {batch_num}: Failed (Status {resp.status_code})", expanded=True):
-                                st.write("**Request Payload Sample (First Item):**")
-                                st.json(batch[0]) # Show the first item to verify brand_id is a string
-                                st.write("**Server Response:**")
-                                st.json(server_response)
-                            
-                    except Exception as e:
-                        error_count += len(batch)
-                        st.error(f"Network Error on Batch {i//batch_size + 1}: {e}")
-
-                    # Progress Update
-                    current_progress = min((i + batch_size) / total_records, 1.0)
-                    progress_bar.progress(current_progress)
-                    status_box.caption(f"Processing... {min(i + batch_size, total_records)}/{total_records}")
-                    
-                    # Rate limiting sleep
-                    time.sleep(sleep_time) 
-
-                st.success(f"Job Complete! Sent: {success_count} | Failed: {error_count}")
-
+                sync_job = sync_core.SyncJob(
+                    total_records,
+                    stats,
+                    curl_command,
+                    file_id=uploaded_file.file_id,
+                    file_name=uploaded_file.name,
+                    required=required
+                )
+                sync_job.start(
+                    batches,
+                    session,
+                    url,
+                    lambda job, batch_num, batch, future: log_batch_result(job, batch_num, batch, future, show_details),
+                    rate_per_sec=req_per_sec if limit_rate else None,
+                    max_workers=concurrency,
+                    compress=compress
+                )
+                st.session_state["sync_job"] = sync_job
+                running = True
+    
     except Exception as e:
         st.error(f"Error reading file: {e}")
+
+if sync_job is not None:
+    st.divider()
+    st.subheader(f"📦 Sync of {sync_job.file_name}")
+    if not uploaded_file or uploaded_file.file_id != sync_job.file_id:
+        st.caption("This sync was started from a file that is no longer selected.")
+    
+    st.subheader("🛠️ Debug: First Batch CURL")
+    st.info("Copy this to your terminal to test the API manually:")
+    st.code(sync_job.curl_command, language="bash")
+    
+    st.divider()
+    
+    if running:
+        job_monitor(sync_job)
+    else:
+        render_job(sync_job, live=False)
+        result = sync_job.result
+        if sync_job.error:
+            st.error(f"Sync stopped: {sync_job.error}")
+        if sync_job.stats["skipped"]:
+            st.warning(f"Skipped {sync_job.stats['skipped']} rows missing {', '.join(sync_job.required)}.")
+        if sync_job.stats["duplicates"]:
+            st.info(f"Dropped {sync_job.stats['duplicates']} duplicate IDs, keeping the last row for each.")
+        if result.cancelled:
+            st.warning(f"Sync Cancelled. Sent: {result.success_count} | Failed: {result.error_count}")
+        else:
+            st.success(f"Job Complete! Sent: {result.success_count} | Failed: {result.error_count}")
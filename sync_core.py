@@ -0,0 +1,433 @@
+"""CSV loading, batch building and sending for Data Sync Pro.
+
+Nothing in here touches Streamlit; app.py owns the widgets, caching and logs
+and calls into these functions.
+"""
+import io
+import csv
+import importlib.util
+import gzip
+import time
+import itertools
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Optional: HTTP/2 needs httpx with its h2 extra installed
+try:
+    import httpx
+except ImportError:
+    httpx = None
+HTTP2_AVAILABLE = httpx is not None and importlib.util.find_spec("h2") is not None
+
+# Optional: vectorized cleaning for uploads past STREAM_THRESHOLD_BYTES
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+REQUIRED_FIELDS = ["id", "title"]
+
+# Above this size the upload is not parsed into a cached DataFrame. Rows are
+# streamed from the bytes with the csv module during the sync instead.
+STREAM_THRESHOLD_BYTES = 200 * 1024 * 1024
+
+# Low-cardinality columns whose values repeat across most rows. While streaming,
+# equal values share one string object instead of one per row.
+INTERN_FIELDS = {"dealer_code", "city", "state", "brand", "brand_id", "category", "availability", "store_id"}
+INTERN_MAX_LEN = 64
+
+# (connect, read) seconds for each batch POST
+REQUEST_TIMEOUT = (5, 30)
+
+# Retry policy for throttling and gateway errors, shared by both HTTP clients
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+# Per-request headers on top of the session's; built once, not per batch
+GZIP_HEADERS = {'Content-Encoding': 'gzip'}
+
+
+# --- CSV LOADING ---
+def parse_headers(headers_input):
+    """Turn the comma-separated header map into a tuple, or None when it's empty.
+
+    A tuple so it can be part of the parse cache key.
+    """
+    return tuple(h.strip() for h in headers_input.split(',') if h.strip()) or None
+
+def _csv_rows(file_bytes):
+    return csv.reader(io.TextIOWrapper(io.BytesIO(file_bytes), encoding='utf-8-sig', newline=''))
+
+def read_header(file_bytes):
+    """Return the file's header row without reading any further."""
+    return [h.strip() for h in next(_csv_rows(file_bytes), [])]
+
+def read_csv(file_bytes, header_map, nrows=None):
+    """Read the uploaded bytes into a DataFrame of strings.
+
+    Full reads go through pyarrow's multithreaded parser and keep Arrow-backed
+    string columns, which use far less memory than object columns and hand
+    straight over to the Arrow cache. pyarrow rejects short rows, which the C
+    parser pads with missing cells as the streaming paths do, so those files
+    are re-read with the C parser. The header map, if given, replaces the
+    file's own header row.
+    """
+    # CRITICAL: dtype=str ensures brand_id and dealer_code are strings, not numbers.
+    # It also skips type inference. Only empty cells count as missing, so values
+    # like "NA" or "null" are sent as-is, the same as in the streaming path.
+    options = dict(header=0, encoding='utf-8-sig', dtype=str, keep_default_na=False, na_values=[""])
+    if nrows is None:
+        try:
+            df = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', dtype_backend='pyarrow', **options)
+        except (pa.ArrowInvalid, pd.errors.ParserError):
+            df = pd.read_csv(io.BytesIO(file_bytes), dtype_backend='pyarrow', **options)
+    else:
+        # The pyarrow engine can't stop after nrows
+        df = pd.read_csv(io.BytesIO(file_bytes), nrows=nrows, **options)
+
+    if header_map:
+        if len(header_map) != len(df.columns):
+            raise ValueError(f"CSV Header Map has {len(header_map)} columns but the file has {len(df.columns)}.")
+        df.columns = list(header_map)
+    else:
+        df.columns = df.columns.str.strip()
+    return df
+
+def _blank_mask(values):
+    # Empty cells are already NaN from read_csv, so isspace() is enough and,
+    # unlike strip(), doesn't build a new string for every cell
+    return values.str.isspace().to_numpy(dtype=bool, na_value=False)
+
+def clean_frame(df):
+    """Drop blank cells and unusable rows. Returns the frame and the number of skipped rows.
+
+    Whitespace-only cells are treated as missing so they are dropped from the
+    JSON. Everything is done per column with vectorized masks. Rows missing a
+    required field are dropped first, so the other columns are only scanned for
+    the rows that will actually be sent.
+    """
+    required = [c for c in REQUIRED_FIELDS if c in df.columns]
+    rows_before = len(df)
+
+    keep = np.ones(len(df), dtype=bool)
+    for c in required:
+        keep &= df[c].notna().to_numpy() & ~_blank_mask(df[c])
+    if not keep.all():
+        df = df[keep].reset_index(drop=True)
+
+    # Required columns are known to be filled in the rows that are left
+    for c in df.columns.difference(required, sort=False):
+        blank = _blank_mask(df[c])
+        if blank.any():
+            df[c] = df[c].mask(blank, np.nan)
+    return df, rows_before - len(df)
+
+def drop_duplicate_ids(df):
+    """Keep only the last row for each id. Returns the frame and the number of rows dropped.
+
+    Later rows win, as they would if every row were sent in order.
+    """
+    if "id" not in df.columns:
+        return df, 0
+    rows_before = len(df)
+    df = df.drop_duplicates(subset=["id"], keep="last", ignore_index=True)
+    return df, rows_before - len(df)
+
+def to_arrow_ipc(df):
+    """Serialize a frame to Arrow IPC bytes."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def from_arrow_ipc(ipc_bytes):
+    """Open Arrow IPC bytes as a table. Zero-copy: the table reads straight from the buffer."""
+    return pa.ipc.open_file(pa.py_buffer(ipc_bytes)).read_all()
+
+
+# --- RECORD BUILDING ---
+def iter_batches(table, batch_size):
+    """Yield (batch_num, records) for each batch of an Arrow table, leaving out empty cells.
+
+    The data stays in Arrow until it is sent: each batch is a zero-copy slice
+    converted column by column, so only one batch's worth of Python objects
+    exists at a time. Empty cells are nulls, which to_pylist() returns as None.
+    """
+    for start in range(0, table.num_rows, batch_size):
+        chunk = table.slice(start, batch_size)
+        # Bound once so the per-row comprehension only touches local names
+        rows = [(name, chunk.column(name).to_pylist()) for name in chunk.column_names]
+        yield (start // batch_size) + 1, [
+            {name: values[j] for name, values in rows if values[j] is not None}
+            for j in range(chunk.num_rows)
+        ]
+
+def iter_csv_batches(file_bytes, header_map, batch_size, stats):
+    """Yield (batch_num, records) straight from the CSV bytes, without pandas.
+
+    Rows are cleaned as they are read with the same rules as clean_frame. Rows
+    missing a required field are counted in stats["skipped"].
+    """
+    reader = _csv_rows(file_bytes)
+    header = next(reader, [])
+    fieldnames = list(header_map) if header_map else [h.strip() for h in header]
+    required = [c for c in REQUIRED_FIELDS if c in fieldnames]
+    intern_positions = [i for i, k in enumerate(fieldnames) if k in INTERN_FIELDS]
+    interned = {}
+
+    batch_num = 0
+    while True:
+        rows = list(itertools.islice(reader, batch_size))
+        if not rows:
+            return
+        batch = []
+        for row in rows:
+            for i in intern_positions:
+                if i < len(row) and len(row[i]) < INTERN_MAX_LEN:
+                    row[i] = interned.setdefault(row[i], row[i])
+            record = {k: v for k, v in zip(fieldnames, row) if v and not v.isspace()}
+            if all(k in record for k in required):
+                batch.append(record)
+            else:
+                stats["skipped"] += 1
+        if batch:
+            batch_num += 1
+            yield batch_num, batch
+
+def iter_polars_batches(file_bytes, header_map, batch_size, stats, dedupe=False):
+    """Yield (batch_num, records) like iter_csv_batches, with the cleaning done by Polars.
+
+    Every column is read as a string, whitespace-only cells become nulls and
+    rows missing a required field are dropped, all as column expressions over
+    Arrow memory. Kept values are not trimmed, same as the other paths.
+    With `dedupe`, duplicate ids are dropped as in drop_duplicate_ids and
+    counted in stats["duplicates"]. The whole file is loaded as Arrow columns when the
+    generator starts; Python dicts are only built one batch at a time.
+    """
+    df = pl.read_csv(file_bytes, infer_schema_length=0, new_columns=list(header_map) if header_map else None)
+    df = df.rename({c: c.strip() for c in df.columns})
+    df = df.with_columns(pl.when(pl.all().str.strip_chars() != "").then(pl.all()))
+    required = [c for c in REQUIRED_FIELDS if c in df.columns]
+    before = df.height
+    df = df.drop_nulls(subset=required)
+    stats["skipped"] += before - df.height
+    if dedupe and "id" in df.columns:
+        before = df.height
+        df = df.unique(subset=["id"], keep="last", maintain_order=True)
+        stats["duplicates"] += before - df.height
+
+    for batch_num, chunk in enumerate(df.iter_slices(batch_size), start=1):
+        yield batch_num, [
+            {k: v for k, v in row.items() if v is not None}
+            for row in chunk.iter_rows(named=True)
+        ]
+
+
+# --- SENDING ---
+def make_adapter(pool_size):
+    """Connection pool for the sync session, sized to the number of in-flight requests.
+
+    Throttling and gateway errors are retried with backoff, waiting as long as
+    the server's Retry-After asks on a 429. A plain 500 is not retried, as it
+    usually means the payload itself was rejected. POST has to be allowed
+    explicitly; re-sending a batch just syncs the same products again. Once
+    the retries run out the last response is returned rather than raised, so
+    it is logged under its own status with the server's body.
+    """
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+def make_http2_client(pool_size):
+    """httpx client that multiplexes every in-flight batch over one HTTP/2 connection.
+
+    HTTP/2 needs only the one connection, but the pool still allows one per
+    worker: an endpoint that only speaks HTTP/1.1 (including any http:// URL)
+    would otherwise queue every request behind a single socket. httpx has no
+    equivalent of Retry; _post_http2 does the backing off.
+    """
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(30.0, connect=5.0)
+    )
+
+def _retry_delay(resp, attempt):
+    # Retry-After in seconds if the server sent one, else exponential backoff
+    try:
+        return max(float(resp.headers["Retry-After"]), 0.0)
+    except (KeyError, ValueError):
+        return RETRY_BACKOFF * (2 ** attempt)
+
+def _post_http2(client, url, body, headers):
+    """POST through httpx, retried on the same statuses and schedule as make_adapter."""
+    # httpx takes raw bytes as content= and has its timeout set on the client
+    resp = client.post(url, content=body, headers=headers)
+    for attempt in range(RETRY_TOTAL):
+        if resp.status_code not in RETRY_STATUSES:
+            break
+        time.sleep(_retry_delay(resp, attempt))
+        resp = client.post(url, content=body, headers=headers)
+    return resp
+
+def _post(session, url, body, headers=None):
+    if httpx is not None and isinstance(session, httpx.Client):
+        return _post_http2(session, url, body, headers)
+    return session.post(url, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+
+def send_batch(session, url, batch, compress=False, gzip_rejected=None):
+    """POST one batch. The body is pre-encoded with orjson instead of requests' json=.
+
+    `session` is a requests.Session or, for HTTP/2, an httpx.Client; both are
+    safe to share between the worker threads. If the endpoint answers a gzip
+    body with 415, the batch is re-sent plain and `gzip_rejected` is set so that
+    later batches skip compression.
+    """
+    body = orjson.dumps({"products": batch}, option=orjson.OPT_SERIALIZE_NUMPY)
+    if compress and not (gzip_rejected is not None and gzip_rejected.is_set()):
+        # Level 1: catalog JSON still shrinks several times over for little CPU
+        resp = _post(session, url, gzip.compress(body, compresslevel=1), headers=GZIP_HEADERS)
+        if resp.status_code != 415:
+            return resp
+        if gzip_rejected is not None:
+            gzip_rejected.set()
+    return _post(session, url, body)
+
+@dataclass
+class SyncResult:
+    """Running totals for a sync, updated as batches complete."""
+    success_count: int = 0
+    error_count: int = 0
+    done_batches: int = 0
+    cancelled: bool = False
+
+    @property
+    def done_records(self):
+        return self.success_count + self.error_count
+
+def response_text(resp):
+    """Response body as text, decoded once.
+
+    requests re-decodes .text on every access and, without a charset header,
+    runs charset detection over the whole body first. The API answers in UTF-8.
+    """
+    return resp.content.decode("utf-8", errors="replace")
+
+def batch_succeeded(future):
+    """A batch counts as sent only if the request completed with a 200."""
+    return future.exception() is None and future.result().status_code == 200
+
+def run_sync(batches, session, url, *, rate_per_sec=None, max_workers=4, compress=False, on_result=None, cancel=None, result=None):
+    """Send every batch from `batches` and return the totals.
+
+    Batches are sent from a worker pool so requests overlap instead of waiting
+    on each other. With `rate_per_sec` set, submissions are spaced to stay under
+    it. `on_result(batch_num, batch, future, result)` is called on the calling
+    thread as each batch completes. Once the `cancel` event is set no further
+    batches are sent; those already in flight still finish and are reported.
+    Pass `result` to have the totals updated in place while the sync runs.
+    """
+    result = result if result is not None else SyncResult()
+    send_interval = 1.0 / rate_per_sec if rate_per_sec else 0.0
+    max_in_flight = max_workers * 2
+    next_batch = next(batches, None)
+    next_send = time.perf_counter()
+    pending = {}
+    gzip_rejected = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while next_batch is not None or pending:
+            if next_batch is not None and cancel is not None and cancel.is_set():
+                next_batch = None
+                result.cancelled = True
+                continue
+            now = time.perf_counter()
+            can_submit = next_batch is not None and len(pending) < max_in_flight
+
+            if can_submit and now >= next_send:
+                batch_num, batch = next_batch
+                future = executor.submit(send_batch, session, url, batch, compress, gzip_rejected)
+                pending[future] = (batch_num, batch)
+                # Deadline based: request latency and logging time count towards
+                # the interval, so the rate is a true cap and not rate + latency
+                next_send = max(next_send, now) + send_interval
+                next_batch = next(batches, None)
+                continue
+
+            # Wait for the next rate limit slot, handling any batch that finishes meanwhile
+            timeout = max(next_send - now, 0) if can_submit else None
+            if not pending:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                batch_num, batch = pending.pop(future)
+                if batch_succeeded(future):
+                    result.success_count += len(batch)
+                else:
+                    result.error_count += len(batch)
+                result.done_batches += 1
+                if on_result:
+                    on_result(batch_num, batch, future, result)
+
+    return result
+
+
+# --- BACKGROUND JOBS ---
+@dataclass
+class SyncJob:
+    """A sync running on a background thread, polled by the UI while it runs.
+
+    The thread never touches Streamlit. Its `record(job, batch_num, batch, future)`
+    callback adds rows to `log_rows` and `failures`, and the UI reads them back.
+    """
+    total_records: int
+    stats: dict
+    curl_command: str = ""
+    # The upload the job was started from, and its required columns
+    file_id: str = ""
+    file_name: str = ""
+    required: list = field(default_factory=list)
+    result: SyncResult = field(default_factory=SyncResult)
+    log_rows: list = field(default_factory=list)
+    failures: list = field(default_factory=list)
+    error: Exception = None
+    cancel: threading.Event = field(default_factory=threading.Event)
+    finished: threading.Event = field(default_factory=threading.Event)
+
+    def start(self, batches, session, url, record, **options):
+        """Run `run_sync` on a daemon thread with this job's result, cancel event and log."""
+        def work():
+            try:
+                run_sync(
+                    batches,
+                    session,
+                    url,
+                    on_result=lambda batch_num, batch, future, result: record(self, batch_num, batch, future),
+                    cancel=self.cancel,
+                    result=self.result,
+                    **options
+                )
+            except Exception as e:
+                self.error = e
+            finally:
+                self.finished.set()
+
+        threading.Thread(target=work, name="data-sync", daemon=True).start()